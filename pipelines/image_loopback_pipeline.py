@@ -5,65 +5,211 @@ date: 2026-02-03
 version: 0.2.0
 license: MIT
 description: Upload tool-generated images and trigger a follow-up vision turn automatically.
-requirements: pydantic, aiohttp
+requirements: pydantic, aiohttp, pybase64, orjson
 """
 
 from __future__ import annotations
 
 import os
-import base64
-import json
 import asyncio
-from typing import Any, Dict, Iterable, Optional, Sequence
+import json
+import re
+import warnings
+from typing import AbstractSet, Any, Dict, Iterable, Optional, Sequence, Union
 
+import aiohttp
 from pydantic import BaseModel, Field
 
+try:
+    import pybase64 as _base64
+except ImportError:  # pragma: no cover - optional SIMD backend
+    import base64 as _base64
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional fast JSON parser
+    orjson = None
+
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+# Upload, follow-up and the next turn all hit the same Open WebUI host; keep sockets warm between turns.
+_KEEPALIVE_TIMEOUT = 60
+
+# Probed in order; the first match wins.
+_TOOL_KEYS = ("tool_name", "tool", "name")
+_IMAGE_KEYS = ("images", "image")
+_DATA_KEYS = ("b64_json", "data", "base64")
+_DEFAULT_MIME_TYPE = "image/png"
+_MISSING = object()
+_WHITESPACE = re.compile(r"[ \t\n\r\v\f]")
+_WHITESPACE_BYTES = re.compile(rb"[ \t\n\r\v\f]")
+# Only these keys can lead to tool output; other subtrees (e.g. long chat text) are skipped.
+_DESCEND_KEYS = frozenset(
+    {
+        "messages",
+        "message",
+        "tool_calls",
+        "tool_results",
+        "function",
+        "output",
+        "choices",
+        "content",
+    }
+)
+
+
 class ExtractedImage:
-    def __init__(self, mime_type: str, data: bytes, source: str) -> None:
+    __slots__ = ("mime_type", "source", "b64_original", "_data")
+
+    def __init__(
+        self,
+        mime_type: str,
+        data: Optional[bytes],
+        source: str,
+        b64_original: Optional[str] = None,
+    ) -> None:
+        if data is None and b64_original is None:
+            raise ValueError("ExtractedImage requires data or b64_original")
         self.mime_type = mime_type
-        self.data = data
         self.source = source
-
-
-def _safe_json_loads(value: str) -> Any:
+        self.b64_original = b64_original
+        self._data = data
+
+    @property
+    def data(self) -> bytes:
+        # Decoded on first access so oversized candidates are never decoded.
+        if self._data is None:
+            self._data = _maybe_decode_base64(self.b64_original) or b""
+        return self._data
+
+    @property
+    def estimated_size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        encoded = self.b64_original
+        return len(encoded) * 3 // 4 - (encoded[-2:].count("=") if encoded else 0)
+
+    def fits_within(self, max_bytes: int) -> bool:
+        if self.estimated_size <= max_bytes:
+            return True
+        # Only whitespace-wrapped payloads overestimate; decode those to check exactly.
+        if self._data is None and _has_whitespace(self.b64_original):
+            return len(self.data) <= max_bytes
+        return False
+
+
+def _safe_json_loads(value: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN/Infinity, out-of-range floats and lone surrogates,
+            # all of which stdlib json (and Python tools emitting it) accepts.
+            pass
     try:
         return json.loads(value)
     except json.JSONDecodeError:
         return None
 
 
-def _maybe_decode_base64(data: str) -> Optional[bytes]:
+def _has_whitespace(data: Union[str, bytes]) -> bool:
+    pattern = _WHITESPACE if isinstance(data, str) else _WHITESPACE_BYTES
+    return pattern.search(data) is not None
+
+
+def _looks_like_base64(data: Any) -> bool:
+    if not isinstance(data, (str, bytes)) or not data:
+        return False
+    # Padded base64 is a multiple of 4 long; only payloads with whitespace (which
+    # validate=False discards) may differ.
+    return not len(data) & 3 or _has_whitespace(data)
+
+
+def _maybe_decode_base64(data: Any) -> Optional[bytes]:
+    if not _looks_like_base64(data):
+        return None
     try:
-        return base64.b64decode(data)
-    except (ValueError, TypeError):
+        return _base64.b64decode(data, validate=False)
+    except ValueError:
         return None
 
 
-def _iter_dicts(obj: Any) -> Iterable[Dict[str, Any]]:
-    if isinstance(obj, dict):
-        yield obj
-        for value in obj.values():
-            yield from _iter_dicts(value)
-    elif isinstance(obj, list):
-        for item in obj:
-            yield from _iter_dicts(item)
+def _split_csv(value: str) -> frozenset[str]:
+    return frozenset(item.strip() for item in value.split(",") if item.strip())
+
+
+def _first_truthy(obj: Dict[str, Any], keys: Sequence[str]) -> Any:
+    for key in keys:
+        value = obj.get(key)
+        if value:
+            return value
+    return None
+
+
+def _iter_dicts(
+    obj: Any, descend_keys: Optional[AbstractSet[str]] = None
+) -> Iterable[Dict[str, Any]]:
+    # Iterative pre-order walk; children are pushed reversed to keep document order.
+    # When descend_keys is given, dict values are only followed under those keys.
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            yield current
+            if descend_keys is None:
+                stack.extend(reversed(current.values()))
+            else:
+                stack.extend(
+                    reversed([value for key, value in current.items() if key in descend_keys])
+                )
+        elif isinstance(current, list):
+            stack.extend(reversed(current))
+
+
+class _ChunkedBytesPayload(aiohttp.payload.BytesPayload):
+    # Sized (keeps Content-Length, replayable on redirects) but written as zero-copy
+    # slices so the writer drains per chunk instead of buffering a second full copy.
+
+    def __init__(self, value: bytes, *args: Any, **kwargs: Any) -> None:
+        # BytesPayload warns that large raw bodies block the loop; the sliced write avoids that.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ResourceWarning)
+            super().__init__(memoryview(value), *args, **kwargs)
+
+    async def write(self, writer: Any) -> None:
+        await self.write_with_length(writer, None)
+
+    async def write_with_length(self, writer: Any, content_length: Optional[int]) -> None:
+        view = self._value if content_length is None else self._value[:content_length]
+        for offset in range(0, len(view), _UPLOAD_CHUNK_SIZE):
+            await writer.write(view[offset : offset + _UPLOAD_CHUNK_SIZE])
+
+
+async def _fetch_url(session: aiohttp.ClientSession, url: str) -> bytes:
+    async with session.get(url, timeout=10) as response:
+        response.raise_for_status()
+        return await response.read()
 
 
 async def extract_tool_images(
     body: Dict[str, Any],
-    allowed_tools: Sequence[str],
+    allowed_tools: Iterable[str],
     allow_url_fetch: bool,
     max_images: int,
-    allowed_mime_types: Sequence[str],
+    allowed_mime_types: Iterable[str],
+    max_bytes: Optional[int] = None,
+    session: Optional[aiohttp.ClientSession] = None,
 ) -> list[ExtractedImage]:
+    allowed_tools = frozenset(allowed_tools)
+    allowed_mime_types = frozenset(allowed_mime_types)
     images: list[ExtractedImage] = []
 
     # Pre-parse any stringified JSON tool calls if possible
     # We will search the whole body but we also specifically look inside tool_calls
 
-    for obj in _iter_dicts(body):
-        tool_name = obj.get("tool_name") or obj.get("tool") or obj.get("name")
-        if tool_name not in allowed_tools:
+    for obj in _iter_dicts(body, _DESCEND_KEYS):
+        tool_name = _first_truthy(obj, _TOOL_KEYS)
+        # Payload values may be dicts/lists, which cannot be looked up in a frozenset.
+        if not isinstance(tool_name, str) or tool_name not in allowed_tools:
             continue
 
         # Look in the arguments if it's a tool_call
@@ -74,13 +220,17 @@ async def extract_tool_images(
         elif isinstance(arguments, dict):
             obj.update(arguments)
 
-        raw_images = obj.get("images") or obj.get("image") or obj.get("output", {}).get("images")
+        raw_images = _first_truthy(obj, _IMAGE_KEYS)
+        if not raw_images:
+            output = obj.get("output")
+            if isinstance(output, dict):
+                raw_images = output.get("images")
 
         # Sometime the result itself is a stringified JSON containing images
         if not raw_images and "content" in obj and isinstance(obj["content"], str):
             content_obj = _safe_json_loads(obj["content"])
             if content_obj and isinstance(content_obj, dict):
-                 raw_images = content_obj.get("images") or content_obj.get("image")
+                 raw_images = _first_truthy(content_obj, _IMAGE_KEYS)
 
         if not raw_images:
             continue
@@ -93,29 +243,44 @@ async def extract_tool_images(
         for image in raw_images:
             if not isinstance(image, dict):
                 continue
-            mime_type = image.get("mime_type") or image.get("content_type") or "image/png"
-            if mime_type not in allowed_mime_types:
+            # Empty strings deliberately fall through, like a missing key.
+            mime_type = image.get("mime_type") or image.get("content_type") or _DEFAULT_MIME_TYPE
+            if not isinstance(mime_type, str) or mime_type not in allowed_mime_types:
                 continue
             data = None
-            if "b64_json" in image:
-                data = _maybe_decode_base64(image["b64_json"])
-            elif "data" in image:
-                data = _maybe_decode_base64(image["data"])
-            elif "base64" in image:
-                data = _maybe_decode_base64(image["base64"])
+            extracted = None
+            # A present-but-null data key still counts as inline data, so it never falls
+            # through to the URL fetch below.
+            encoded = _MISSING
+            for key in _DATA_KEYS:
+                if key in image:
+                    encoded = image[key]
+                    break
+            if isinstance(encoded, str):
+                if _looks_like_base64(encoded):
+                    extracted = ExtractedImage(
+                        mime_type=mime_type, data=None, source=tool_name, b64_original=encoded
+                    )
+            elif encoded is not _MISSING:
+                data = _maybe_decode_base64(encoded)
             elif "url" in image and allow_url_fetch:
-                import aiohttp
                 try:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(image["url"], timeout=10) as response:
-                            response.raise_for_status()
-                            data = await response.read()
+                    if session is None:
+                        async with aiohttp.ClientSession() as temp_session:
+                            data = await _fetch_url(temp_session, image["url"])
+                    else:
+                        data = await _fetch_url(session, image["url"])
                 except Exception as e:
                     print(f"Error fetching image from URL: {e}")
                     continue
 
             if data:
-                images.append(ExtractedImage(mime_type=mime_type, data=data, source=tool_name))
+                extracted = ExtractedImage(mime_type=mime_type, data=data, source=tool_name)
+            if extracted is not None:
+                # Oversized images are dropped before decoding; survivors are decoded before
+                # counting so neither oversized nor undecodable payloads use up max_images.
+                if (max_bytes is None or extracted.fits_within(max_bytes)) and extracted.data:
+                    images.append(extracted)
             if len(images) >= max_images:
                 return images
     return images
@@ -147,6 +312,43 @@ class Pipeline:
                 "pipelines": ["*"],
             }
         )
+        self._valve_cache_source: Optional[tuple[str, str, str]] = None
+        self._refresh_valve_cache()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._followup_tasks: set[asyncio.Task] = set()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # One pooled keep-alive session shared by uploads, URL fetches and follow-ups.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=_KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def on_shutdown(self) -> None:
+        # Let in-flight follow-ups finish before their shared session is closed.
+        if self._followup_tasks:
+            await asyncio.gather(*self._followup_tasks, return_exceptions=True)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _refresh_valve_cache(self) -> None:
+        source = (
+            self.valves.allowed_tools,
+            self.valves.allowed_mime_types,
+            self.valves.openwebui_base_url,
+        )
+        if source == self._valve_cache_source:
+            return
+        self._allowed_tools = _split_csv(self.valves.allowed_tools)
+        self._allowed_mime_types = _split_csv(self.valves.allowed_mime_types)
+        base_url = self.valves.openwebui_base_url
+        self._upload_url = f"{base_url}/api/v1/files/?process=false&process_in_background=false"
+        self._chat_url = f"{base_url}/api/chat/completions"
+        self._valve_cache_source = source
+
+    async def on_valves_updated(self) -> None:
+        self._refresh_valve_cache()
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         return body
@@ -159,98 +361,101 @@ class Pipeline:
         if metadata.get("loopback_done"):
             return body
 
-        allowed_tools = [item.strip() for item in self.valves.allowed_tools.split(",") if item.strip()]
-        allowed_mime_types = [
-            item.strip() for item in self.valves.allowed_mime_types.split(",") if item.strip()
-        ]
+        # Valves may also be mutated in place, so re-check the raw strings cheaply.
+        self._refresh_valve_cache()
 
         images = await extract_tool_images(
             body=body,
-            allowed_tools=allowed_tools,
+            allowed_tools=self._allowed_tools,
             allow_url_fetch=self.valves.allow_url_fetch,
             max_images=self.valves.max_images,
-            allowed_mime_types=allowed_mime_types,
+            allowed_mime_types=self._allowed_mime_types,
+            max_bytes=self.valves.max_bytes,
+            session=await self._get_session() if self.valves.allow_url_fetch else None,
         )
 
         if not images:
             return body
 
-        filtered = [image for image in images if len(image.data) <= self.valves.max_bytes]
-        if not filtered:
-            return body
-
         api_key = self.valves.openwebui_api_key or os.getenv("OPENWEBUI_API_KEY", "")
         if not api_key:
             return body
 
-        uploaded_file_ids = []
-
-        import aiohttp
-
-        async with aiohttp.ClientSession() as session:
-            for image in filtered:
-                form_data = aiohttp.FormData()
-                form_data.add_field(
-                    'file',
-                    image.data,
-                    filename='image.png',
-                    content_type=image.mime_type
-                )
-
-                try:
-                    async with session.post(
-                        f"{self.valves.openwebui_base_url}/api/v1/files/?process=false&process_in_background=false",
-                        headers={"Authorization": f"Bearer {api_key}"},
-                        data=form_data,
-                        timeout=30,
-                    ) as response:
-                        response.raise_for_status()
-                        payload = await response.json()
-                        file_id = payload.get("id") or payload.get("file_id")
-                        if file_id:
-                            uploaded_file_ids.append(file_id)
-                except Exception as e:
-                    print(f"Error uploading image: {e}")
+        auth_headers = {"Authorization": f"Bearer {api_key}"}
 
-            if not uploaded_file_ids:
-                return body
+        session = await self._get_session()
+        # Upload concurrently so wall time is the slowest upload, not the sum; order is preserved.
+        results = await asyncio.gather(
+            *(self._upload_image(session, image, auth_headers) for image in images)
+        )
+        uploaded_file_ids = [file_id for file_id in results if file_id]
 
-            chat_id = body.get("chat_id") or body.get("conversation_id")
-            messages = body.get("messages", [])
+        if not uploaded_file_ids:
+            return body
 
-            # OpenWebUI and OpenAI expect files to be tied to the message content or as a direct property
-            # We add it as an array of files in the message, and set loopback_done to True
-            followup_message = {
-                "role": "user",
-                "content": self.valves.auto_prompt,
-                "metadata": {"loopback_done": True},
-                "files": [{"id": file_id} for file_id in uploaded_file_ids],
-            }
-            new_messages = [*messages, followup_message]
+        chat_id = body.get("chat_id") or body.get("conversation_id")
+        messages = body.get("messages", [])
+
+        # OpenWebUI and OpenAI expect files to be tied to the message content or as a direct property
+        # We add it as an array of files in the message, and set loopback_done to True
+        followup_message = {
+            "role": "user",
+            "content": self.valves.auto_prompt,
+            "metadata": {"loopback_done": True},
+            "files": [{"id": file_id} for file_id in uploaded_file_ids],
+        }
+        new_messages = [*messages, followup_message]
+
+        followup_payload = {
+            "model": body.get("model"),
+            "messages": new_messages,
+            "metadata": {"loopback_done": True},
+        }
+        if chat_id:
+            followup_payload["chat_id"] = chat_id
+
+        # Fire and forget the follow-up request so we don't block the current response stream
+        # Keep a reference so the task is not garbage collected before it completes.
+        task = asyncio.create_task(self._send_followup(api_key, followup_payload))
+        self._followup_tasks.add(task)
+        task.add_done_callback(self._followup_tasks.discard)
 
-            followup_payload = {
-                "model": body.get("model"),
-                "messages": new_messages,
-                "metadata": {"loopback_done": True},
-            }
-            if chat_id:
-                followup_payload["chat_id"] = chat_id
+        return body
 
-            # Fire and forget the follow-up request so we don't block the current response stream
-            asyncio.create_task(self._send_followup(api_key, followup_payload))
+    async def _upload_image(
+        self, session: aiohttp.ClientSession, image: ExtractedImage, headers: Dict[str, str]
+    ) -> Optional[str]:
+        form_data = aiohttp.FormData()
+        form_data.add_field(
+            'file',
+            _ChunkedBytesPayload(image.data, content_type=image.mime_type),
+            filename='image.png',
+            content_type=image.mime_type
+        )
 
-        return body
+        try:
+            async with session.post(
+                self._upload_url,
+                headers=headers,
+                data=form_data,
+                timeout=30,
+            ) as response:
+                response.raise_for_status()
+                payload = await response.json()
+                return payload.get("id") or payload.get("file_id")
+        except Exception as e:
+            print(f"Error uploading image: {e}")
+            return None
 
     async def _send_followup(self, api_key: str, followup_payload: dict):
-        import aiohttp
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.valves.openwebui_base_url}/api/chat/completions",
-                    headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-                    json=followup_payload,
-                    timeout=60,
-                ) as response:
-                    response.raise_for_status()
+            session = await self._get_session()
+            async with session.post(
+                self._chat_url,
+                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                json=followup_payload,
+                timeout=60,
+            ) as response:
+                response.raise_for_status()
         except Exception as e:
             print(f"Error sending follow-up completion: {e}")
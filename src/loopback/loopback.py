@@ -2,11 +2,16 @@
 
 from __future__ import annotations
 
-import base64
+import functools
 import logging
 import os
 from dataclasses import dataclass, field
-from typing import Iterable, List, Mapping, Optional, Sequence
+from typing import FrozenSet, Iterable, List, Mapping, Optional, Sequence
+
+try:
+    import pybase64 as _base64
+except ImportError:  # pragma: no cover - optional SIMD backend
+    import base64 as _base64
 
 
 DEFAULT_FOLLOWUP_PROMPT = (
@@ -20,25 +25,33 @@ _logger = logging.getLogger(LOGGER_NAME)
 _logger.addHandler(logging.NullHandler())
 
 
+_last_log_level: Optional[str] = None
+
+
 def _configure_logging(log_level: str) -> None:
-    if not log_level:
+    # Called on every evaluation; only touch logger state when the level changes.
+    global _last_log_level
+    if not log_level or log_level == _last_log_level:
         return
     normalized = log_level.strip().upper()
     if normalized in {"OFF", "NONE", "DISABLED", "FALSE", "0"}:
         _logger.disabled = True
-        return
-    _logger.disabled = False
-    _logger.setLevel(normalized)
+    else:
+        _logger.disabled = False
+        _logger.setLevel(normalized)
+    _last_log_level = log_level
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class LoopbackConfig:
     enabled: bool = False
-    allowed_tools: Sequence[str] = ("generate_image",)
-    allowed_mime_types: Sequence[str] = (
-        "image/png",
-        "image/jpeg",
-        "image/webp",
+    allowed_tools: FrozenSet[str] = frozenset({"generate_image"})
+    allowed_mime_types: FrozenSet[str] = frozenset(
+        {
+            "image/png",
+            "image/jpeg",
+            "image/webp",
+        }
     )
     max_bytes: int = 8 * 1024 * 1024
     max_images: int = 2
@@ -46,16 +59,24 @@ class LoopbackConfig:
     allow_url_fetch: bool = False
     log_level: str = "WARNING"
 
+    def __post_init__(self) -> None:
+        # Accept any iterable from callers but store frozensets for O(1) membership.
+        object.__setattr__(self, "allowed_tools", frozenset(self.allowed_tools))
+        object.__setattr__(self, "allowed_mime_types", frozenset(self.allowed_mime_types))
+
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def from_env() -> "LoopbackConfig":
+        # Parsed once per process; call ``LoopbackConfig.from_env.cache_clear()``
+        # after changing IMAGE_LOOPBACK_* variables at runtime.
         enabled = os.getenv("IMAGE_LOOPBACK_ENABLE", "false").lower() == "true"
-        allowed_tools = tuple(
+        allowed_tools = frozenset(
             tool.strip()
             for tool in os.getenv("IMAGE_LOOPBACK_ALLOWED_TOOLS", "generate_image").split(","
             )
             if tool.strip()
         )
-        allowed_mime_types = tuple(
+        allowed_mime_types = frozenset(
             item.strip()
             for item in os.getenv(
                 "IMAGE_LOOPBACK_ALLOWED_MIME_TYPES", "image/png,image/jpeg,image/webp"
@@ -79,28 +100,30 @@ class LoopbackConfig:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class ToolImage:
     mime_type: str
     data: bytes
     source: str = "tool"
+    # Base64 text from the tool payload; reused as-is instead of re-encoding ``data``.
+    b64_original: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ToolResult:
     tool_name: str
     images: List[ToolImage] = field(default_factory=list)
     metadata: Mapping[str, str] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(slots=True)
 class UploadedFile:
     file_id: str
     mime_type: str
     size: int
 
 
-@dataclass
+@dataclass(slots=True)
 class LoopbackDecision:
     should_loopback: bool
     reason: str
@@ -119,14 +142,15 @@ def should_loopback(
     model_supports_vision: bool,
 ) -> LoopbackDecision:
     _configure_logging(config.log_level)
-    _logger.debug(
-        "Evaluating loopback: enabled=%s already_looped=%s tool=%s model_supports_vision=%s images=%d",
-        config.enabled,
-        already_looped,
-        tool_result.tool_name,
-        model_supports_vision,
-        len(tool_result.images),
-    )
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug(
+            "Evaluating loopback: enabled=%s already_looped=%s tool=%s model_supports_vision=%s images=%d",
+            config.enabled,
+            already_looped,
+            tool_result.tool_name,
+            model_supports_vision,
+            len(tool_result.images),
+        )
     if not config.enabled:
         reason = "loopback disabled"
         _logger.info("Loopback skipped: %s", reason)
@@ -135,16 +159,17 @@ def should_loopback(
         reason = "loopback already performed"
         _logger.info("Loopback skipped: %s", reason)
         return LoopbackDecision(False, reason)
-    if tool_result.tool_name not in config.allowed_tools:
-        reason = "tool not allowlisted"
+    # Most tool results carry no images, so reject those before the other gates.
+    if not tool_result.images:
+        reason = "no images in tool result"
         _logger.info("Loopback skipped: %s", reason)
         return LoopbackDecision(False, reason)
     if not model_supports_vision:
         reason = "model lacks vision support"
         _logger.info("Loopback skipped: %s", reason)
         return LoopbackDecision(False, reason)
-    if not tool_result.images:
-        reason = "no images in tool result"
+    if tool_result.tool_name not in config.allowed_tools:
+        reason = "tool not allowlisted"
         _logger.info("Loopback skipped: %s", reason)
         return LoopbackDecision(False, reason)
     _logger.info("Loopback eligible for tool=%s with %d images", tool_result.tool_name, len(tool_result.images))
@@ -155,19 +180,24 @@ def filter_images(config: LoopbackConfig, images: Iterable[ToolImage]) -> List[T
     _configure_logging(config.log_level)
     image_list = list(images)
     filtered: List[ToolImage] = []
+    # Checked once so disabled debug logging costs nothing per image.
+    debug = _logger.isEnabledFor(logging.DEBUG)
     for image in image_list:
         if image.mime_type not in config.allowed_mime_types:
-            _logger.debug("Skipping image due to mime type: %s", image.mime_type)
+            if debug:
+                _logger.debug("Skipping image due to mime type: %s", image.mime_type)
             continue
         if len(image.data) > config.max_bytes:
-            _logger.debug(
-                "Skipping image due to size: %d bytes (max %d)",
-                len(image.data),
-                config.max_bytes,
-            )
+            if debug:
+                _logger.debug(
+                    "Skipping image due to size: %d bytes (max %d)",
+                    len(image.data),
+                    config.max_bytes,
+                )
             continue
         filtered.append(image)
-        _logger.debug("Accepted image %d/%d", len(filtered), config.max_images)
+        if debug:
+            _logger.debug("Accepted image %d/%d", len(filtered), config.max_images)
         if len(filtered) >= config.max_images:
             break
     _logger.info("Filtered %d images from %d candidates", len(filtered), len(image_list))
@@ -175,8 +205,14 @@ def filter_images(config: LoopbackConfig, images: Iterable[ToolImage]) -> List[T
 
 
 def encode_base64_images(images: Sequence[ToolImage]) -> List[str]:
-    _logger.debug("Encoding %d images to base64", len(images))
-    return [base64.b64encode(image.data).decode("utf-8") for image in images]
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug("Encoding %d images to base64", len(images))
+    return [
+        image.b64_original
+        if image.b64_original is not None
+        else _base64.b64encode(image.data).decode("ascii")
+        for image in images
+    ]
 
 
 class FileUploader:
@@ -185,6 +221,10 @@ class FileUploader:
     def upload(self, image: ToolImage) -> UploadedFile:
         raise NotImplementedError
 
+    def upload_many(self, images: Sequence[ToolImage]) -> List[UploadedFile]:
+        """Upload a batch in input order; override to upload concurrently."""
+        return [self.upload(image) for image in images]
+
 
 class VisionProvider:
     """Interface for sending follow-up vision requests."""
@@ -209,7 +249,7 @@ def apply_loopback(
     uploader: FileUploader,
     provider: VisionProvider,
 ) -> LoopbackDecision:
-    _configure_logging(config.log_level)
+    # should_loopback configures logging for this config.
     decision = should_loopback(config, tool_result, already_looped, model_supports_vision)
     if not decision.should_loopback:
         return decision
@@ -220,10 +260,10 @@ def apply_loopback(
         _logger.info("Loopback skipped: %s", reason)
         return LoopbackDecision(False, reason)
 
-    uploaded_files: List[UploadedFile] = []
-    for image in filtered:
-        _logger.debug("Uploading image from source=%s mime_type=%s bytes=%d", image.source, image.mime_type, len(image.data))
-        uploaded_files.append(uploader.upload(image))
+    if _logger.isEnabledFor(logging.DEBUG):
+        for image in filtered:
+            _logger.debug("Uploading image from source=%s mime_type=%s bytes=%d", image.source, image.mime_type, len(image.data))
+    uploaded_files = list(uploader.upload_many(filtered))
 
     images_base64 = encode_base64_images(filtered)
     prompt = decision.followup_prompt or config.auto_followup_prompt
@@ -2,26 +2,127 @@
 
 from __future__ import annotations
 
-import base64
 import json
 import logging
-from dataclasses import dataclass
-from typing import Any, Dict, Iterable, List, Optional, Sequence
+import re
+from typing import TYPE_CHECKING, AbstractSet, Any, Dict, Iterable, List, Optional, Sequence, Union
+
+try:
+    import pybase64 as _base64
+except ImportError:  # pragma: no cover - optional SIMD backend
+    import base64 as _base64
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional fast JSON parser
+    orjson = None
+
+if TYPE_CHECKING:
+    import requests
 
 
 LOGGER_NAME = "loopback"
 _logger = logging.getLogger(f"{LOGGER_NAME}.pipeline_utils")
 _logger.addHandler(logging.NullHandler())
 
+# Probed in order; the first match wins.
+_TOOL_KEYS = ("tool_name", "tool", "name")
+_IMAGE_KEYS = ("images", "image")
+_DATA_KEYS = ("b64_json", "data", "base64")
+_DEFAULT_MIME_TYPE = "image/png"
+_MISSING = object()
+_WHITESPACE = re.compile(r"[ \t\n\r\v\f]")
+_WHITESPACE_BYTES = re.compile(rb"[ \t\n\r\v\f]")
+# Only these keys can lead to tool output; other subtrees (e.g. long chat text) are skipped.
+_DESCEND_KEYS = frozenset(
+    {
+        "messages",
+        "message",
+        "tool_calls",
+        "tool_results",
+        "function",
+        "output",
+        "choices",
+        "content",
+    }
+)
+
 
-@dataclass
 class ExtractedImage:
-    mime_type: str
-    data: bytes
-    source: str
+    """Extracted tool image whose base64 payload is decoded on first ``data`` access."""
+
+    __slots__ = ("mime_type", "source", "b64_original", "_data")
+
+    def __init__(
+        self,
+        mime_type: str,
+        data: Optional[bytes],
+        source: str,
+        b64_original: Optional[str] = None,
+    ) -> None:
+        if data is None and b64_original is None:
+            raise ValueError("ExtractedImage requires data or b64_original")
+        self.mime_type = mime_type
+        self.source = source
+        # Base64 text the tool supplied, kept so it can be forwarded without re-encoding.
+        self.b64_original = b64_original
+        self._data = data
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = _maybe_decode_base64(self.b64_original) or b""
+        return self._data
+
+    @property
+    def estimated_size(self) -> int:
+        """Decoded size without decoding; an upper bound for whitespace-wrapped payloads."""
+        if self._data is not None:
+            return len(self._data)
+        encoded = self.b64_original
+        return len(encoded) * 3 // 4 - (encoded[-2:].count("=") if encoded else 0)
+
+    def fits_within(self, max_bytes: int) -> bool:
+        if self.estimated_size <= max_bytes:
+            return True
+        # Only whitespace-wrapped payloads overestimate; decode those to check exactly.
+        if self._data is None and _has_whitespace(self.b64_original):
+            return len(self.data) <= max_bytes
+        return False
+
+    def __repr__(self) -> str:
+        return (
+            f"ExtractedImage(mime_type={self.mime_type!r}, source={self.source!r}, "
+            f"estimated_size={self.estimated_size})"
+        )
+
+
+_http_session: Optional["requests.Session"] = None
+
 
+def _get_http_session() -> "requests.Session":
+    # Shared keep-alive pool so repeated URL fetches reuse connections.
+    global _http_session
+    if _http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
 
-def _safe_json_loads(value: str) -> Any:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session = session
+    return _http_session
+
+
+def _safe_json_loads(value: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN/Infinity, out-of-range floats and lone surrogates,
+            # all of which stdlib json (and Python tools emitting it) accepts.
+            pass
     try:
         return json.loads(value)
     except json.JSONDecodeError:
@@ -29,43 +130,95 @@ def _safe_json_loads(value: str) -> Any:
         return None
 
 
-def _maybe_decode_base64(data: str) -> Optional[bytes]:
+def _has_whitespace(data: Union[str, bytes]) -> bool:
+    pattern = _WHITESPACE if isinstance(data, str) else _WHITESPACE_BYTES
+    return pattern.search(data) is not None
+
+
+def _looks_like_base64(data: Any) -> bool:
+    if not isinstance(data, (str, bytes)) or not data:
+        return False
+    # Padded base64 is a multiple of 4 long; only payloads with whitespace (which
+    # validate=False discards) may differ.
+    return not len(data) & 3 or _has_whitespace(data)
+
+
+def _accept_base64(data: Any) -> bool:
+    if _looks_like_base64(data):
+        return True
+    _logger.debug("Skipping malformed base64 payload")
+    return False
+
+
+def _maybe_decode_base64(data: Any) -> Optional[bytes]:
+    if not _accept_base64(data):
+        return None
     try:
-        return base64.b64decode(data)
-    except (ValueError, TypeError):
+        return _base64.b64decode(data, validate=False)
+    except ValueError:
         _logger.debug("Failed to decode base64 payload")
         return None
 
 
-def _iter_dicts(obj: Any) -> Iterable[Dict[str, Any]]:
-    if isinstance(obj, dict):
-        yield obj
-        for value in obj.values():
-            yield from _iter_dicts(value)
-    elif isinstance(obj, list):
-        for item in obj:
-            yield from _iter_dicts(item)
+def _first_truthy(obj: Dict[str, Any], keys: Sequence[str]) -> Any:
+    for key in keys:
+        value = obj.get(key)
+        if value:
+            return value
+    return None
+
+
+def _iter_dicts(
+    obj: Any, descend_keys: Optional[AbstractSet[str]] = None
+) -> Iterable[Dict[str, Any]]:
+    # Iterative pre-order walk; children are pushed reversed to keep document order.
+    # When descend_keys is given, dict values are only followed under those keys.
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            yield current
+            if descend_keys is None:
+                stack.extend(reversed(current.values()))
+            else:
+                stack.extend(
+                    reversed([value for key, value in current.items() if key in descend_keys])
+                )
+        elif isinstance(current, list):
+            stack.extend(reversed(current))
 
 
 def extract_tool_images(
     body: Dict[str, Any],
-    allowed_tools: Sequence[str],
+    allowed_tools: Iterable[str],
     allow_url_fetch: bool,
     max_images: int,
-    allowed_mime_types: Sequence[str],
+    allowed_mime_types: Iterable[str],
+    max_bytes: Optional[int] = None,
 ) -> List[ExtractedImage]:
+    allowed_tools = frozenset(allowed_tools)
+    allowed_mime_types = frozenset(allowed_mime_types)
     images: List[ExtractedImage] = []
-    _logger.debug(
-        "Extracting images from payload with allowed_tools=%s allow_url_fetch=%s max_images=%d",
-        allowed_tools,
-        allow_url_fetch,
-        max_images,
-    )
-    for obj in _iter_dicts(body):
-        tool_name = obj.get("tool_name") or obj.get("tool") or obj.get("name")
-        if tool_name not in allowed_tools:
+    # Checked once so disabled debug logging costs nothing per visited image.
+    debug = _logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        _logger.debug(
+            "Extracting images from payload with allowed_tools=%s allow_url_fetch=%s max_images=%d max_bytes=%s",
+            allowed_tools,
+            allow_url_fetch,
+            max_images,
+            max_bytes,
+        )
+    for obj in _iter_dicts(body, _DESCEND_KEYS):
+        tool_name = _first_truthy(obj, _TOOL_KEYS)
+        # Payload values may be dicts/lists, which cannot be looked up in a frozenset.
+        if not isinstance(tool_name, str) or tool_name not in allowed_tools:
             continue
-        raw_images = obj.get("images") or obj.get("image") or obj.get("output", {}).get("images")
+        raw_images = _first_truthy(obj, _IMAGE_KEYS)
+        if not raw_images:
+            output = obj.get("output")
+            if isinstance(output, dict):
+                raw_images = output.get("images")
         if not raw_images:
             continue
         if isinstance(raw_images, str):
@@ -75,27 +228,54 @@ def extract_tool_images(
         for image in raw_images:
             if not isinstance(image, dict):
                 continue
-            mime_type = image.get("mime_type") or image.get("content_type") or "image/png"
-            if mime_type not in allowed_mime_types:
-                _logger.debug("Skipping image with mime_type=%s", mime_type)
+            # Empty strings deliberately fall through, like a missing key.
+            mime_type = image.get("mime_type") or image.get("content_type") or _DEFAULT_MIME_TYPE
+            if not isinstance(mime_type, str) or mime_type not in allowed_mime_types:
+                if debug:
+                    _logger.debug("Skipping image with mime_type=%s", mime_type)
                 continue
-            data = None
-            if "b64_json" in image:
-                data = _maybe_decode_base64(image["b64_json"])
-            elif "data" in image:
-                data = _maybe_decode_base64(image["data"])
-            elif "base64" in image:
-                data = _maybe_decode_base64(image["base64"])
+            extracted = None
+            # A present-but-null data key still counts as inline data, so it never falls
+            # through to the URL fetch below.
+            encoded = _MISSING
+            for key in _DATA_KEYS:
+                if key in image:
+                    encoded = image[key]
+                    break
+            if isinstance(encoded, str):
+                # Decoding is deferred until the size check below passes.
+                if _accept_base64(encoded):
+                    extracted = ExtractedImage(
+                        mime_type=mime_type, data=None, source=tool_name, b64_original=encoded
+                    )
+            elif encoded is not _MISSING:
+                data = _maybe_decode_base64(encoded)
+                if data:
+                    extracted = ExtractedImage(mime_type=mime_type, data=data, source=tool_name)
             elif "url" in image and allow_url_fetch:
-                import requests
-
                 _logger.info("Fetching image from url=%s", image["url"])
-                response = requests.get(image["url"], timeout=10)
+                response = _get_http_session().get(image["url"], timeout=10)
                 response.raise_for_status()
-                data = response.content
-            if data:
-                images.append(ExtractedImage(mime_type=mime_type, data=data, source=tool_name))
-                _logger.debug("Added image from tool=%s mime_type=%s", tool_name, mime_type)
+                if response.content:
+                    extracted = ExtractedImage(
+                        mime_type=mime_type, data=response.content, source=tool_name
+                    )
+            if extracted is not None:
+                if max_bytes is not None and not extracted.fits_within(max_bytes):
+                    # Oversized images are dropped before decoding and do not use up max_images.
+                    if debug:
+                        _logger.debug(
+                            "Skipping image due to size: %d bytes (max %d)",
+                            extracted.estimated_size,
+                            max_bytes,
+                        )
+                elif not extracted.data:
+                    # Decode survivors before counting them so a bad payload cannot take a slot.
+                    _logger.debug("Skipping image whose base64 payload failed to decode")
+                else:
+                    images.append(extracted)
+                    if debug:
+                        _logger.debug("Added image from tool=%s mime_type=%s", tool_name, mime_type)
             if len(images) >= max_images:
                 _logger.info("Reached max_images=%d while extracting images", max_images)
                 return images
@@ -1,6 +1,8 @@
 import pytest
 import asyncio
-from pipelines.image_loopback_pipeline import extract_tool_images
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from pipelines.image_loopback_pipeline import Pipeline, _ChunkedBytesPayload, extract_tool_images
 
 @pytest.mark.asyncio
 async def test_extract_tool_images_with_arguments():
@@ -43,3 +45,180 @@ async def test_extract_tool_images_with_content():
     assert len(images) == 1
     assert images[0].data == b"image-bytes"
     assert images[0].mime_type == "image/png"
+
+@pytest.mark.asyncio
+async def test_extract_tool_images_ignores_unhashable_tool_values():
+    body = {
+        "messages": [
+            {"role": "assistant", "tool": {"type": "function"}},
+            {
+                "role": "tool",
+                "tool_name": "generate_image",
+                "images": [{"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="}],
+            },
+        ]
+    }
+    images = await extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+    )
+    assert [image.data for image in images] == [b"image-bytes"]
+
+@pytest.mark.asyncio
+async def test_extract_tool_images_drops_undecodable_payloads():
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": [
+                    {"mime_type": "image/png", "b64_json": "!!!!"},
+                    {"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="},
+                ],
+            }
+        ]
+    }
+    images = await extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=1,
+        allowed_mime_types=["image/png"],
+    )
+    assert [image.data for image in images] == [b"image-bytes"]
+
+@pytest.mark.asyncio
+async def test_outlet_uploads_concurrently_and_sends_followup():
+    uploads = []
+    chats = []
+    in_flight = {"now": 0, "max": 0}
+
+    async def upload(request):
+        assert request.headers["Authorization"] == "Bearer test-key"
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        reader = await request.multipart()
+        part = await reader.next()
+        data = await part.read()
+        # The first upload finishes last; file ids must still follow input order.
+        await asyncio.sleep(0.2 if data == b"first" else 0.05)
+        in_flight["now"] -= 1
+        uploads.append((data, part.headers["Content-Type"], request.headers.get("Content-Length")))
+        return web.json_response({"id": f"file-{data.decode()}"})
+
+    async def chat(request):
+        chats.append(await request.json())
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/api/v1/files/", upload)
+    app.router.add_post("/api/chat/completions", chat)
+    server = TestServer(app)
+    await server.start_server()
+
+    pipeline = Pipeline()
+    pipeline.valves = pipeline.Valves(
+        pipelines=["*"],
+        enable=True,
+        openwebui_base_url=str(server.make_url("")).rstrip("/"),
+        openwebui_api_key="test-key",
+        allowed_mime_types="image/png,image/jpeg",
+    )
+    await pipeline.on_valves_updated()
+
+    body = {
+        "model": "vision-model",
+        "chat_id": "chat-1",
+        "messages": [
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "tool_name": "generate_image",
+                        "images": [
+                            {"mime_type": "image/png", "b64_json": "Zmlyc3Q="},
+                            {"mime_type": "image/jpeg", "b64_json": "c2Vjb25k"},
+                        ],
+                    }
+                ],
+            }
+        ],
+    }
+    try:
+        assert await pipeline.outlet(body) is body
+        session = pipeline._session
+        await pipeline.on_shutdown()
+    finally:
+        await server.close()
+
+    assert in_flight["max"] == 2
+    # Completion order differs from input order, proving the uploads overlapped.
+    assert [(data, mime_type) for data, mime_type, _ in uploads] == [
+        (b"second", "image/jpeg"),
+        (b"first", "image/png"),
+    ]
+    assert all(content_length is not None for _, _, content_length in uploads)
+    assert len(chats) == 1
+    followup = chats[0]
+    assert followup["chat_id"] == "chat-1"
+    assert followup["metadata"] == {"loopback_done": True}
+    assert followup["messages"][-1]["files"] == [{"id": "file-first"}, {"id": "file-second"}]
+    assert session.closed
+    assert pipeline._session is None
+    assert not pipeline._followup_tasks
+
+@pytest.mark.asyncio
+async def test_extract_tool_images_does_not_fetch_url_when_data_key_is_null():
+    fetched = []
+
+    class RecordingSession:
+        def get(self, url, **kwargs):
+            # The pipeline swallows fetch errors, so record instead of raising.
+            fetched.append(url)
+            raise RuntimeError("unexpected fetch")
+
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": [{"mime_type": "image/png", "b64_json": None, "url": "http://169.254.169.254/x"}],
+            }
+        ]
+    }
+    images = await extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=True,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+        session=RecordingSession(),
+    )
+    assert images == []
+    assert fetched == []
+
+@pytest.mark.asyncio
+async def test_upload_payload_is_sized_and_returns_raw_bytes():
+    payload = _ChunkedBytesPayload(b"\x89PNG\xff", content_type="image/png")
+    assert payload.size == 5
+    assert bytes(await payload.as_bytes()) == b"\x89PNG\xff"
+
+@pytest.mark.asyncio
+async def test_extract_tool_images_parses_stdlib_only_json():
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "content": '{"seed": NaN, "images": [{"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="}]}'
+            }
+        ]
+    }
+    images = await extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+    )
+    assert [image.data for image in images] == [b"image-bytes"]
@@ -55,3 +55,38 @@ def test_apply_loopback_triggers_followup_with_image_payload():
     assert len(uploader.uploaded) == 1
     assert len(provider.calls) == 1
     assert provider.calls[0]["images_base64"][0] != ""
+
+
+class BatchUploader(FakeUploader):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def upload_many(self, images):
+        self.batches.append(list(images))
+        return super().upload_many(images)
+
+
+def test_apply_loopback_uploads_filtered_images_as_one_batch():
+    config = LoopbackConfig(enabled=True, max_images=2)
+    tool_result = ToolResult(
+        tool_name="generate_image",
+        images=[
+            ToolImage(mime_type="image/png", data=b"first"),
+            ToolImage(mime_type="image/gif", data=b"skipped"),
+            ToolImage(mime_type="image/png", data=b"second"),
+        ],
+    )
+    uploader = BatchUploader()
+
+    decision = apply_loopback(
+        config,
+        tool_result,
+        already_looped=False,
+        model_supports_vision=True,
+        uploader=uploader,
+        provider=FakeProvider(),
+    )
+
+    assert len(decision.uploaded_files) == 2
+    assert [[image.data for image in batch] for batch in uploader.batches] == [[b"first", b"second"]]
@@ -1,4 +1,4 @@
-from loopback.loopback import LoopbackConfig, ToolImage, ToolResult, should_loopback
+from loopback.loopback import LoopbackConfig, ToolImage, ToolResult, encode_base64_images, should_loopback
 
 
 def test_should_loopback_respects_marker_and_gates():
@@ -18,3 +18,63 @@ def test_should_loopback_respects_marker_and_gates():
     decision = should_loopback(config, tool_result, already_looped=False, model_supports_vision=False)
     assert decision.should_loopback is False
     assert decision.reason == "model lacks vision support"
+
+
+def test_from_env_is_cached_until_cleared(monkeypatch):
+    monkeypatch.setenv("IMAGE_LOOPBACK_ENABLE", "true")
+    LoopbackConfig.from_env.cache_clear()
+    config = LoopbackConfig.from_env()
+    assert config.enabled is True
+
+    monkeypatch.setenv("IMAGE_LOOPBACK_ENABLE", "false")
+    assert LoopbackConfig.from_env() is config
+
+    LoopbackConfig.from_env.cache_clear()
+    assert LoopbackConfig.from_env().enabled is False
+    LoopbackConfig.from_env.cache_clear()
+
+
+def test_config_normalizes_allowlists_to_frozensets():
+    config = LoopbackConfig(allowed_tools=["generate_image"], allowed_mime_types=("image/png",))
+    assert config.allowed_tools == frozenset({"generate_image"})
+    assert config.allowed_mime_types == frozenset({"image/png"})
+
+
+def test_encode_base64_images_reuses_original_payload():
+    images = [
+        ToolImage(mime_type="image/png", data=b"image-bytes", b64_original="aW1hZ2UtYnl0ZXM="),
+        ToolImage(mime_type="image/png", data=b"123"),
+    ]
+    assert encode_base64_images(images) == ["aW1hZ2UtYnl0ZXM=", "MTIz"]
+
+
+def test_log_level_is_applied_only_when_it_changes():
+    import logging
+
+    logger = logging.getLogger("loopback")
+    tool_result = ToolResult(tool_name="generate_image")
+
+    should_loopback(LoopbackConfig(log_level="DEBUG"), tool_result, False, True)
+    assert logger.level == logging.DEBUG
+
+    logger.setLevel(logging.ERROR)
+    should_loopback(LoopbackConfig(log_level="DEBUG"), tool_result, False, True)
+    assert logger.level == logging.ERROR
+
+    should_loopback(LoopbackConfig(log_level="OFF"), tool_result, False, True)
+    assert logger.disabled is True
+    should_loopback(LoopbackConfig(log_level="WARNING"), tool_result, False, True)
+    assert logger.disabled is False
+    assert logger.level == logging.WARNING
+
+
+def test_should_loopback_rejects_imageless_results_before_allowlist():
+    config = LoopbackConfig(enabled=True)
+    tool_result = ToolResult(tool_name="web_search")
+
+    decision = should_loopback(config, tool_result, already_looped=False, model_supports_vision=True)
+    assert decision.reason == "no images in tool result"
+
+    tool_result.images.append(ToolImage(mime_type="image/png", data=b"123"))
+    decision = should_loopback(config, tool_result, already_looped=False, model_supports_vision=True)
+    assert decision.reason == "tool not allowlisted"
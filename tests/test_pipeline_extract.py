@@ -1,4 +1,4 @@
-from loopback.pipeline_utils import extract_tool_images
+from loopback.pipeline_utils import ExtractedImage, _maybe_decode_base64, extract_tool_images
 
 
 def test_extract_tool_images_from_tool_output():
@@ -27,3 +27,218 @@ def test_extract_tool_images_from_tool_output():
     assert len(images) == 1
     assert images[0].data == b"image-bytes"
     assert images[0].mime_type == "image/png"
+    assert images[0].b64_original == "aW1hZ2UtYnl0ZXM="
+
+
+def test_extract_tool_images_handles_deep_nesting_in_order():
+    first = {"tool_name": "generate_image", "images": [{"mime_type": "image/png", "b64_json": "Zmlyc3Q="}]}
+    second = {"tool_name": "generate_image", "images": [{"mime_type": "image/png", "b64_json": "c2Vjb25k"}]}
+    nested = {"tool_results": [first, second]}
+    for _ in range(2000):
+        nested = {"messages": [nested]}
+
+    images = extract_tool_images(
+        body=nested,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=1,
+        allowed_mime_types=["image/png"],
+    )
+
+    assert [image.data for image in images] == [b"first"]
+
+
+def test_extract_tool_images_skips_unrelated_subtrees():
+    tool = {"tool_name": "generate_image", "images": [{"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="}]}
+    body = {"metadata": {"history": [tool]}, "messages": [{"role": "tool", "content": [tool]}]}
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+    )
+
+    assert len(images) == 1
+
+
+def test_maybe_decode_base64_prefilters_invalid_payloads():
+    assert _maybe_decode_base64("aW1hZ2UtYnl0ZXM=") == b"image-bytes"
+    assert _maybe_decode_base64("aW1hZ2U\ntYnl0ZXM=") == b"image-bytes"
+    assert _maybe_decode_base64("aW1h Z2U=") == b"image"
+    assert _maybe_decode_base64(b"aW1h\tZ2U=") == b"image"
+    assert _maybe_decode_base64("aW1hZ2UtYnl0ZXM") is None
+    assert _maybe_decode_base64("") is None
+    assert _maybe_decode_base64(None) is None
+    assert _maybe_decode_base64(["aW1h"]) is None
+
+
+def test_extracted_image_checks_size_before_decoding():
+    image = ExtractedImage(
+        mime_type="image/png", data=None, source="generate_image", b64_original="aW1hZ2UtYnl0ZXM="
+    )
+
+    assert image.estimated_size == len(b"image-bytes")
+    assert image.fits_within(len(b"image-bytes")) is True
+    assert image.fits_within(len(b"image-bytes") - 1) is False
+    assert image._data is None
+    assert image.data == b"image-bytes"
+
+
+def test_extract_tool_images_treats_empty_mime_type_as_missing():
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": [
+                    {"mime_type": "", "content_type": "image/jpeg", "b64_json": "aW1hZ2UtYnl0ZXM="},
+                    {"mime_type": "", "content_type": "", "b64_json": "aW1hZ2UtYnl0ZXM="},
+                ],
+            }
+        ]
+    }
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=2,
+        allowed_mime_types=["image/png", "image/jpeg"],
+    )
+
+    assert [image.mime_type for image in images] == ["image/jpeg", "image/png"]
+
+
+def test_extract_tool_images_skips_oversized_without_using_a_slot():
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": [
+                    {"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXMtdG9vLWxhcmdl"},
+                    {"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="},
+                ],
+            }
+        ]
+    }
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=1,
+        allowed_mime_types=["image/png"],
+        max_bytes=len(b"image-bytes"),
+    )
+
+    assert [image.data for image in images] == [b"image-bytes"]
+
+
+def test_extract_tool_images_ignores_unhashable_tool_and_mime_values():
+    body = {
+        "messages": [
+            {"role": "assistant", "tool": {"type": "function"}},
+            {
+                "role": "tool",
+                "tool_name": "generate_image",
+                "images": [
+                    {"mime_type": ["image/png"], "b64_json": "aW1hZ2UtYnl0ZXM="},
+                    {"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="},
+                ],
+            },
+        ]
+    }
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+    )
+
+    assert [image.data for image in images] == [b"image-bytes"]
+
+
+def test_extract_tool_images_drops_undecodable_payloads_without_using_a_slot():
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": [
+                    {"mime_type": "image/png", "b64_json": "!!!!"},
+                    {"mime_type": "image/png", "b64_json": "a==="},
+                    {"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM="},
+                ],
+            }
+        ]
+    }
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=1,
+        allowed_mime_types=["image/png"],
+    )
+
+    assert [image.data for image in images] == [b"image-bytes"]
+
+
+def test_extract_tool_images_does_not_fetch_url_when_data_key_is_null(monkeypatch):
+    from loopback import pipeline_utils
+
+    def fail_session():
+        raise AssertionError("URL must not be fetched when a data key is present")
+
+    monkeypatch.setattr(pipeline_utils, "_get_http_session", fail_session)
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": [{"mime_type": "image/png", "b64_json": None, "url": "http://169.254.169.254/x"}],
+            }
+        ]
+    }
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=True,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+    )
+
+    assert images == []
+
+
+def test_extract_tool_images_parses_stdlib_only_json():
+    body = {
+        "tool_results": [
+            {
+                "tool_name": "generate_image",
+                "images": '[{"mime_type": "image/png", "b64_json": "aW1hZ2UtYnl0ZXM=", "score": NaN}]',
+            }
+        ]
+    }
+
+    images = extract_tool_images(
+        body=body,
+        allowed_tools=["generate_image"],
+        allow_url_fetch=False,
+        max_images=2,
+        allowed_mime_types=["image/png"],
+    )
+
+    assert [image.data for image in images] == [b"image-bytes"]
+
+
+def test_extracted_image_decodes_whitespace_wrapped_payload_to_check_size():
+    image = ExtractedImage(
+        mime_type="image/png", data=None, source="generate_image", b64_original="aW1h Z2Ut Ynl0 ZXM="
+    )
+
+    assert image.estimated_size > len(b"image-bytes")
+    assert image.fits_within(len(b"image-bytes")) is True
+    assert image.data == b"image-bytes"